@@ -1,42 +1,109 @@
 import re
+from urllib.parse import urldefrag, urljoin
 
 import bs4
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# https://uibakery.io/regex-library/email-regex-python (without the quoted local-part branch)
+pattern = "(?i)(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*)@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\\[(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?|[a-z0-9-]*[a-z0-9]:(?:[\\x01-\\x08\\x0b\\x0c\\x0e-\\x1f\\x21-\\x5a\\x53-\\x7f]|\\\\[\\x01-\\x09\\x0b\\x0c\\x0e-\\x7f])+)\\])"
+# Without re2 fall back to a simpler pattern that python's backtracking `re` can run in linear time:
+# matches only start at the beginning of a run and the possessive loops never give characters back
+EMAIL_PATTERN = r"(?<![a-zA-Z0-9._%+-])[a-zA-Z0-9._%+-]++@(?:[a-zA-Z0-9-]++\.)+[a-zA-Z]{2,}"
+
+# valradar re-executes this module for every call, keep the pattern compiled by the first run
+if "_EMAIL_RE" not in globals():
+    _EMAIL_RE = re2.compile(pattern.encode()) if re2 is not None else re.compile(EMAIL_PATTERN.encode())
 
-# https://uibakery.io/regex-library/email-regex-python
-pattern = "(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|\"(?:[\\x01-\\x08\\x0b\\x0c\\x0e-\\x1f\\x21\\x23-\\x5b\\x5d-\\x7f]|\\\\[\\x01-\\x09\\x0b\\x0c\\x0e-\\x7f])*\")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\\[(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?|[a-z0-9-]*[a-z0-9]:(?:[\\x01-\\x08\\x0b\\x0c\\x0e-\\x1f\\x21-\\x5a\\x53-\\x7f]|\\\\[\\x01-\\x09\\x0b\\x0c\\x0e-\\x7f])+)\\])"
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 }
 
+# Pages larger than this are truncated before scanning
+MAX_BYTES = 5_000_000
+
+
+def make_session():
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch(session, url):
+    # Read at most MAX_BYTES of the decompressed body, it is scanned and parsed as bytes so it is never decoded as a whole
+    with session.get(url, timeout=10, stream=True) as response:
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk[:MAX_BYTES - size])
+            size += len(chunks[-1])
+            if size >= MAX_BYTES:
+                break
+        # The final url after redirects, without the trailing slash DataContext adds, is the base for relative links
+        return {"content": b"".join(chunks), "url": response.url}
+
+
+def resolve_link(base_url, href):
+    # Resolve relative links against the page and drop fragments so the dedup sees one url per page
+    try:
+        return urldefrag(urljoin(base_url, href))[0]
+    except ValueError:
+        # Malformed hrefs such as "http://[oops/" are skipped instead of losing the rest of the page
+        return None
+
+
+def find_hrefs(content):
+    if HTMLParser is not None:
+        return [a.attributes.get("href") for a in HTMLParser(content).css("a[href]")]
+
+    # Only build the <a href> tags instead of the whole document tree
+    soup = bs4.BeautifulSoup(content, "html.parser", parse_only=bs4.SoupStrainer("a", href=True))
+    return [link.get("href") for link in soup.find_all("a", href=True)]
+
 
 class DataContext:
-    def __init__(self, url):
+    def __init__(self, url, processed_urls=None, session=None):
         self.url = url if url.endswith("/") else url + "/"
         self.data = {}
-        self.emails = []
+        self.processed_urls = processed_urls if processed_urls is not None else set()
+        self.session = session if session is not None else make_session()
+        self.emails = set()
 
     def collect(self):
         # Do some work and store state
         if not self.url.startswith("http"):
-            return []
+            return
+
+        if self.url in self.processed_urls:
+            return
+
+        self.processed_urls.add(self.url)
+        self.data.update(fetch(self.session, self.url))
+        self.emails = {m.group().decode("ascii", "replace") for m in _EMAIL_RE.finditer(self.data["content"])}
 
-        self.data["content"] = requests.get(self.url, headers=headers).text
-        self.emails = re.findall(pattern, self.data["content"])
+        links = self.extract_links()
+        # Only the emails are needed from here on, don't hold on to the page until processing
+        self.data.clear()
 
-        return [DataContext(link) for link in self.extract_links()]
+        for link in links:
+            yield DataContext(link, self.processed_urls, self.session)
 
     def extract_links(self):
-        soup = bs4.BeautifulSoup(self.data["content"], "html.parser")
-        hrefs = []
-        for link in soup.find_all("a"):
-            href: str = link.get("href").__str__()
-            if href:
-                if href.startswith("/") or href.startswith("#"):
-                    hrefs.append(self.url + href)
-                else:
-                    hrefs.append(href)
-        return hrefs
+        links = (resolve_link(self.data["url"], href) for href in find_hrefs(self.data["content"]) if href)
+        return [link for link in links if link]
 
     def process(self):
         if len(self.emails) > 0:
@@ -50,11 +117,14 @@ def _VALRADAR_INIT(args):
         print("no urls provided")
         exit(1)
 
-    return [DataContext(url) for url in args]
+    processed_urls = set()
+    # Shared by every context so connections are kept alive across pages on the same host
+    session = make_session()
+    return [DataContext(url, processed_urls, session) for url in args]
 
 
 def _VALRADAR_COLLECT_DATA(context):
-    return context.collect()
+    return list(context.collect())
 
 
 def _VALRADAR_PROCESS_DATA(context):
@@ -1,32 +1,49 @@
 import os
+import re
 import yara
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".valradar", "cache")
 
 class YaraContext:
-    def __init__(self, directory, rules):
+    def __init__(self, directory, rules, pool):
         self.directory = directory
         self.rules = rules
+        self.pool = pool
         self.files = []
 
     def collect(self):
         directories = []
 
         try:
-            for file in os.listdir(self.directory):
-                if os.path.isfile(os.path.join(self.directory, file)):
-                    self.files.append(os.path.join(self.directory, file))
-                elif os.path.isdir(os.path.join(self.directory, file)):
-                    directories.append(os.path.join(self.directory, file))
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    # A broken entry (e.g. a symlink loop) is skipped like os.path.isfile/isdir did
+                    try:
+                        if entry.is_file():
+                            self.files.append(entry.path)
+                        elif entry.is_dir():
+                            directories.append(entry.path)
+                    except OSError:
+                        continue
         except Exception as e:
             return []
 
-        return [YaraContext(directory, self.rules) for directory in directories]
+        return [YaraContext(directory, self.rules, self.pool) for directory in directories]
+
+    def scan_file(self, file):
+        # An unreadable file shouldn't abort the rest of the directory
+        try:
+            return file, self.rules.match(filepath=file)
+        except (yara.Error, OSError):
+            return file, []
 
     def process(self):
         rule_matches = []
-        for file in self.files:
-            content = open(file, "rb").read()
-            matches = self.rules.match(data=content)
+        # Matching releases the GIL, so files in a directory are scanned concurrently
+        for file, matches in self.pool.map(self.scan_file, self.files):
             if matches:
                 rule_matches.append(f'{os.path.basename(file)}: {", ".join([match.rule for match in matches])}')
 
@@ -36,13 +53,44 @@ class YaraContext:
             return None
 
 
+def load_rules(rules_file):
+    # Compiled rules are cached by the hash of their source, compiling large rule sets takes seconds
+    with open(rules_file, "rb") as f:
+        source = f.read()
+
+    # The hash only covers this file, a cached copy could hide edits made to included files
+    if re.search(rb'^\s*include\s+"', source, re.MULTILINE):
+        return yara.compile(rules_file)
+
+    digest = hashlib.sha256(source).hexdigest()
+    cache_file = os.path.join(CACHE_DIRECTORY, f"yara-{yara.__version__}-{digest}.yarac")
+
+    if os.path.isfile(cache_file):
+        try:
+            return yara.load(cache_file)
+        except yara.Error:
+            pass
+
+    rules = yara.compile(rules_file)
+    partial_file = f"{cache_file}.{os.getpid()}"
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        rules.save(partial_file)
+        os.replace(partial_file, cache_file)
+    except (yara.Error, OSError):
+        pass
+
+    return rules
+
+
 def _YARA_INIT(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("--directory", type=str, required=True)
     parser.add_argument("--rules_file", type=str, required=True)
     args = parser.parse_args(args)
-    rules = yara.compile(args.rules_file)
-    return [YaraContext(args.directory, rules)]
+    rules = load_rules(args.rules_file)
+    pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+    return [YaraContext(args.directory, rules, pool)]
 
 def _YARA_COLLECT_DATA(context):
     return context.collect()
@@ -1,50 +1,184 @@
 import requests
+from requests.adapters import HTTPAdapter
 import bs4
 import re
 import argparse
+import threading
+from urllib.parse import urldefrag, urljoin
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
 
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 }
 
+# Pages larger than this are truncated before scanning
+MAX_BYTES = 5_000_000
+
+def make_session():
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch(session, url):
+    # Read at most MAX_BYTES of the decompressed body, it is scanned and parsed as bytes so it is never decoded as a whole
+    with session.get(url, timeout=10, stream=True) as response:
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk[:MAX_BYTES - size])
+            size += len(chunks[-1])
+            if size >= MAX_BYTES:
+                break
+        # The final url after redirects, without the trailing slash DataContext adds, is the base for relative links
+        return {'content': b''.join(chunks), 'url': response.url, 'encoding': response.encoding or 'utf-8'}
+
+def decode(content, encoding):
+    try:
+        return content.decode(encoding, errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+# The pieces of a regex: an escape, a character set or any other single character
+REGEX_TOKEN = re.compile(r'\\.|\[\^?\]?(?:\\.|[^\]])*\]|.', re.DOTALL)
+UNICODE_ESCAPE = re.compile(r'\\[uUNxwWbBdDsS]')
+
+def needs_text(regex):
+    # Non-ASCII characters and these escapes mean something else (or nothing) in a bytes pattern, and `.`
+    # or a negated set would match a single byte of a multi-byte character
+    if not regex.isascii():
+        return True
+    for token in REGEX_TOKEN.findall(regex):
+        if token == '.' or token.startswith('[^') or UNICODE_ESCAPE.search(token):
+            return True
+    return False
+
+def compile_type(regex):
+    # Patterns that only need ASCII run on the raw page bytes, the others on the decoded text
+    return re.compile(regex) if needs_text(regex) else re.compile(regex.encode())
+
+def find_matches(pattern, content):
+    # Report what findall did: the group of a single-group pattern ('' when it didn't take part), else the whole match
+    group = 1 if pattern.groups == 1 else 0
+    return {m.group(group) or content[:0] for m in pattern.finditer(content)}
+
+def resolve_link(base_url, href):
+    # Resolve relative links against the page and drop fragments so the dedup sees one url per page
+    try:
+        return urldefrag(urljoin(base_url, href))[0]
+    except ValueError:
+        # Malformed hrefs such as "http://[oops/" are skipped instead of losing the rest of the page
+        return None
+
+def find_hrefs(content):
+    if HTMLParser is not None:
+        return [a.attributes.get('href') for a in HTMLParser(content).css('a[href]')]
+
+    # Only build the <a href> tags instead of the whole document tree
+    soup = bs4.BeautifulSoup(content, 'html.parser', parse_only=bs4.SoupStrainer('a', href=True))
+    return [link.get('href') for link in soup.find_all('a', href=True)]
+
+# Syntax python and hyperscan both accept but read differently: `a{,3}` is a repeat in python but literal
+# text in hyperscan and `[[:alpha:]]` is a plain set in python but a POSIX class in hyperscan
+PYTHON_ONLY_SYNTAX = re.compile(rb'\{,\d*\}|\[:')
+
+def can_prefilter(pattern):
+    return isinstance(pattern.pattern, bytes) and not PYTHON_ONLY_SYNTAX.search(pattern.pattern)
+
+class Prefilter:
+    """Scans a page once with hyperscan to find the types that can match on it"""
+    def __init__(self, types):
+        # Types hyperscan can't be trusted to rule out are always scanned with `re`
+        self.always = {k for k in types.keys() if not can_prefilter(types[k])}
+        self.names = [k for k in types.keys() if k not in self.always]
+        self.lock = threading.Lock()
+        self.db = hyperscan.Database()
+        # PREFILTER approximates constructs hyperscan can't run (backreferences, lookarounds), so a
+        # reported type may still not match under `re` but a type that matches is never missed
+        flags = hyperscan.HS_FLAG_PREFILTER | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_ALLOWEMPTY
+        self.db.compile(
+            expressions=[types[k].pattern for k in self.names],
+            ids=list(range(len(self.names))),
+            elements=len(self.names),
+            flags=[flags] * len(self.names),
+        )
+
+    def candidates(self, content):
+        found = set(self.always)
+
+        def on_match(id, start, end, flags, context):
+            found.add(self.names[id])
+
+        # The database shares one scratch space, so scans can't overlap
+        with self.lock:
+            self.db.scan(content, match_event_handler=on_match)
+        return found
+
+def make_prefilter(types):
+    if hyperscan is None or sum(can_prefilter(p) for p in types.values()) < 2:
+        return None
+
+    try:
+        return Prefilter(types)
+    except hyperscan.error:
+        return None
+
 class DataContext:
-    def __init__(self, url, types, processed_urls = []):
+    def __init__(self, url, types, processed_urls = None, prefilter = None, session = None):
         self.url = url if url.endswith("/") else url + "/"
         self.data = {}
-        self.processed_urls = processed_urls
+        self.processed_urls = processed_urls if processed_urls is not None else set()
         self.types = types
+        self.prefilter = prefilter
+        self.session = session if session is not None else make_session()
         self.types_result = {}
 
     def collect(self):
         # Do some work and store state
         if not self.url.startswith('http'):
-            return []
+            return
 
         if self.url in self.processed_urls:
-            return []
+            return
 
-        self.data['content'] = requests.get(self.url, headers=headers).text
+        self.data.update(fetch(self.session, self.url))
+        candidates = self.prefilter.candidates(self.data['content']) if self.prefilter else self.types.keys()
+        # Only decode the page when a non-ASCII pattern has to run on it
+        text = decode(self.data['content'], self.data['encoding']) if any(isinstance(self.types[k].pattern, str) for k in candidates) else None
         for k in self.types.keys():
-            self.types_result[k] = re.findall(self.types[k], self.data['content'])
+            if k not in candidates:
+                self.types_result[k] = set()
+            elif isinstance(self.types[k].pattern, str):
+                self.types_result[k] = find_matches(self.types[k], text)
+            else:
+                self.types_result[k] = {match.decode('utf-8', 'replace') for match in find_matches(self.types[k], self.data['content'])}
+
+        links = self.extract_links()
+        # Only the matches are needed from here on, don't hold on to the page until processing
+        self.data.clear()
 
-        return [DataContext(link, self.types, self.processed_urls) for link in self.extract_links()]
+        for link in links:
+            yield DataContext(link, self.types, self.processed_urls, self.prefilter, self.session)
 
     def extract_links(self):
         if self.url in self.processed_urls:
             return []
 
-        self.processed_urls.append(self.url)
+        self.processed_urls.add(self.url)
 
-        soup = bs4.BeautifulSoup(self.data['content'], 'html.parser')
-        hrefs = []
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href:
-                if href.startswith('/') or href.startswith("#"):
-                    hrefs.append(self.url + href)
-                else:
-                    hrefs.append(href)
-        return hrefs
+        links = (resolve_link(self.data['url'], href) for href in find_hrefs(self.data['content']) if href)
+        return [link for link in links if link]
 
     def process(self):
         if len(self.types_result.keys()) > 0:
@@ -58,13 +192,15 @@ class DataContext:
 def _VALRADAR_INIT(args):
     parser = argparse.ArgumentParser("web.regex", description="D")
     parser.add_argument("url", help="The url to initiate scraping on")
-    parser.add_argument("-t", "--type", help="A mapping of a type to a regex that matches it -t letters='[a-zA-Z]'", action="append", default=[])
+    parser.add_argument("-t", "--type", help="A mapping of a type to a regex that matches it -t letters='[a-zA-Z]'. Patterns with non-ASCII characters, `.`, negated sets or \\w \\d \\s \\b style escapes are matched against the decoded page, others against the raw page bytes. Types using python-only syntax such as {,n} or [[:alpha:]] are never skipped by the hyperscan prefilter", action="append", default=[])
     args = parser.parse_args(args)
-    types_dict = { a.split("=")[0]:a.split("=")[1] for a in args.type }
-    return [DataContext(args.url, types_dict)]
+    types_dict = { a.split("=")[0]:compile_type(a.split("=")[1]) for a in args.type }
+    # Shared by every context so connections are kept alive across pages on the same host
+    session = make_session()
+    return [DataContext(args.url, types_dict, prefilter=make_prefilter(types_dict), session=session)]
 
 def _VALRADAR_COLLECT_DATA(context):
-    return context.collect()
+    return list(context.collect())
 
 def _VALRADAR_PROCESS_DATA(context):
     return context.process()